@@ -19,67 +19,145 @@ Usage:
 
 # --- Imports (Combined from all 3 scripts) ---
 import argparse
+import asyncio
+import hashlib
 import json
+import logging
 import os
-import time
+import random
+import signal
 from urllib.parse import urljoin, urlparse, unquote
 import tempfile
 import shutil
-import sys
 import pathlib
-from time import sleep
 
-import requests
-from bs4 import BeautifulSoup
+import httpx
+import orjson
 from dotenv import load_dotenv
 from google import genai
-from google.genai import types
-from supabase import create_client, Client
+from google.genai import errors, types
+from lxml import etree, html as lxml_html
+from supabase import AsyncClient, acreate_client
 
 # --- Environment Loading ---
 # Load .env file for API keys (GEMINI_API_KEYS, SUPABASE_URL, SUPABASE_KEY)
 load_dotenv()
 
+# --- Logging ---
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+logger = logging.getLogger("dgms")
+# httpx logs every request at INFO and the Gemini SDK is similarly chatty; keep them to problems
+for noisy_logger in ("httpx", "httpcore", "google_genai"):
+    logging.getLogger(noisy_logger).setLevel(logging.WARNING)
+
 # --- Constants ---
 DEFAULT_URL = "https://www.dgms.gov.in/UserView/index?mid=1362"
-DEFAULT_JSON = "safety_alerts.json"
+DEFAULT_JSON = "safety_alerts.json"  # Newline-delimited despite the name; see load_known
+DEFAULT_CACHE_DIR = ".gemini_cache"  # Extraction results keyed by PDF content hash
 DEFAULT_INTERVAL = 5  # seconds (Poll once per minute)
+MAX_CONCURRENT_PDFS = 5  # Upper bound on PDFs processed in parallel per poll
+MAX_TRIES = 6  # Gemini attempts per PDF before giving up
+MAX_BACKOFF = 60  # seconds (Cap on the exponential backoff between attempts)
+ROTATE_KEY_STATUS_CODES = (401, 403, 429)  # Auth/quota/rate-limit errors that warrant another API key
+GEMINI_MODEL = "gemini-flash-latest"
+DEFAULT_KICK_HOST = "127.0.0.1"  # Interface the optional POST /kick endpoint listens on
+
+# --- Shared HTTP Client ---
+# One pooled client for the whole process so repeated polls of the DGMS host
+# (and the PDF downloads that follow) reuse keep-alive TCP/TLS connections.
+CLIENT = httpx.AsyncClient(
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    timeout=20.0,
+    headers={"User-Agent": "alert-watcher/1.0"},
+    # requests followed redirects by default; httpx doesn't, so opt in to keep 3xx working
+    follow_redirects=True,
+)
 
 
 # =============================================================================
 # AGENT 1: DGMS Safety Alert Watcher
 # =============================================================================
 
-def fetch_html(url: str, timeout: int = 20) -> str:
-    """Fetch HTML from a live URL."""
-    print(f"Fetching HTML from: {url}")
-    resp = requests.get(url, timeout=timeout, headers={"User-Agent": "alert-watcher/1.0"})
+# Compiled once: <a> tags under '#skipmaincontent' whose href ends with '.pdf' (any case)
+PDF_XPATH = etree.XPath(
+    "//*[@id='skipmaincontent']//a["
+    "substring(translate(normalize-space(@href), 'PDF', 'pdf'),"
+    " string-length(normalize-space(@href)) - 3) = '.pdf']"
+)
+
+
+async def fetch_html(url: str, timeout: int = 20, etag: str = None, last_modified: str = None) -> tuple:
+    """
+    Fetch HTML from a live URL using a conditional GET.
+
+    Returns:
+        tuple: (html, etag, last_modified). html is the raw body as bytes (so lxml
+        can honour the page's own encoding declaration), or None when the server
+        answers 304 Not Modified; etag/last_modified are the validators to send next time.
+    """
+    logger.debug("Fetching HTML from: %s", url)
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    resp = await CLIENT.get(url, timeout=timeout, headers=headers)
+    if resp.status_code == 304:
+        return None, etag, last_modified
     resp.raise_for_status()
-    return resp.text
+    return resp.content, resp.headers.get("ETag"), resp.headers.get("Last-Modified")
 
 
-def extract_pdf_names_and_urls(html: str, base_url: str = "") -> dict:
+def extract_pdf_names_and_urls(html: bytes, base_url: str = "") -> dict:
     """
     Parse HTML and find <a> tags under '#skipmaincontent' whose href ends with '.pdf'.
     
     Returns:
         dict: A dictionary mapping {pdf_basename: full_pdf_url}
     """
-    soup = BeautifulSoup(html, "html.parser")
-    anchors = soup.select("#skipmaincontent a[href$='.pdf'], #skipmaincontent a[href$='.PDF']")
+    # lxml refuses an empty document outright; there are no alerts to find in one anyway
+    if not html or not html.strip():
+        return {}
+    doc = lxml_html.fromstring(html)
+    anchors = PDF_XPATH(doc)
     names_to_urls = {}
+    # Parsed once per page; only needed for root-relative hrefs
+    base_parsed = urlparse(base_url)
     
     for a in anchors:
         href = a.get("href", "").strip()
         if not href:
             continue
             
-        # resolve relative URLs against base_url
-        full_url = urljoin(base_url, href)
-        
-        # parse path portion to get basename
-        parsed = urlparse(full_url)
-        basename = os.path.basename(parsed.path)
+        # Fast paths below only take plain hrefs: no query/fragment, ';params', dot segments,
+        # IPv6 brackets or embedded whitespace, all of which urljoin/urlparse normalize,
+        # split off or validate
+        simple = "/." not in href and not any(c in href for c in "?#;[]\t\r\n")
+        # http(s) href with a host and a path after it, e.g. 'https://host/x.pdf'
+        host_and_path = href.split("//", 1)[1] if simple and href.startswith(("http://", "https://")) else ""
+        is_http_with_path = host_and_path[:1] not in ("", "/") and "/" in host_and_path
+        # plain relative or root-relative path, no scheme or network location
+        is_plain_path = simple and ":" not in href and not href.startswith("//")
+
+        # Absolute hrefs (the common DGMS case) are used as-is and root-relative ones are
+        # joined to the base host; everything else is resolved by urljoin
+        try:
+            if is_http_with_path:
+                full_url = href
+            elif is_plain_path and href.startswith("/") and base_parsed.scheme and base_parsed.netloc:
+                full_url = f"{base_parsed.scheme}://{base_parsed.netloc}{href}"
+            else:
+                full_url = urljoin(base_url, href)
+
+            # basename is the last path segment; anything not taking a fast path goes through urlparse
+            if is_http_with_path or is_plain_path:
+                basename = href.rsplit("/", 1)[-1]
+            else:
+                basename = os.path.basename(urlparse(full_url).path)
+        except ValueError:
+            # e.g. a malformed IPv6 host; skip this link rather than the whole page
+            continue
         if not basename:
             continue
         
@@ -96,28 +174,50 @@ def extract_pdf_names_and_urls(html: str, base_url: str = "") -> dict:
     return names_to_urls
 
 
-def load_known(json_path: str) -> list:
-    """Loads the list of known PDF basenames from the JSON file."""
-    if not os.path.exists(json_path):
-        return []
-    with open(json_path, "r", encoding="utf-8") as f:
-        try:
-            data = json.load(f)
-            if isinstance(data, list):
-                return data
-            return list(data)
-        except Exception:
-            return []
+def load_known(json_path: str) -> set:
+    """
+    Loads the set of known PDF basenames from the append-only log (one per line).
 
+    The log is compacted on load if it holds duplicate lines or a partially written
+    last line (which is dropped, not kept as a name), or if it is still in the
+    legacy JSON-list format, which is migrated in place.
+    """
+    if not os.path.exists(json_path):
+        return set()
+    with open(json_path, "rb") as f:
+        raw = f.read()
 
-def save_known_atomic(list_data: list, json_path: str):
-    """Atomically saves the list of known PDF basenames to the JSON file."""
-    dirn = os.path.dirname(os.path.abspath(json_path)) or "."
-    fd, tmp = tempfile.mkstemp(prefix="." + os.path.basename(json_path) + ".", dir=dirn)
+    # Legacy format: the whole file is one JSON list. A newline-delimited log that merely
+    # starts with '[' (e.g. a "[draft] ..." name) or a corrupt legacy file fails this test
+    # and is read line by line below instead.
+    try:
+        legacy = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        legacy = None
+    if isinstance(legacy, list):
+        known = {name for name in legacy if isinstance(name, str)}
+        save_known_atomic(known, json_path)
+        return known
+
+    # Anything after the last newline is an append cut short by a crash
+    complete = raw[:raw.rfind(b"\n") + 1]
+    lines = [line for line in complete.decode("utf-8", errors="replace").splitlines() if line]
+    known = set(lines)
+    if raw.strip() and not known:
+        logger.warning("No complete alert names in %r; every alert on the page will be treated as new.", json_path)
+    if len(lines) > 2 * len(known) or complete != raw:
+        save_known_atomic(known, json_path)
+    return known
+
+
+def write_atomic(data: bytes, path: str):
+    """Atomically writes bytes to the given path via a temp file and rename."""
+    dirn = os.path.dirname(os.path.abspath(path)) or "."
+    fd, tmp = tempfile.mkstemp(prefix="." + os.path.basename(path) + ".", dir=dirn)
     try:
-        with os.fdopen(fd, "w", encoding="utf-8") as f:
-            json.dump(list_data, f, indent=2, ensure_ascii=False)
-        shutil.move(tmp, json_path)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        shutil.move(tmp, path)
     finally:
         if os.path.exists(tmp):
             try:
@@ -126,6 +226,24 @@ def save_known_atomic(list_data: list, json_path: str):
                 pass
 
 
+def save_json_atomic(data, json_path: str):
+    """Atomically writes any JSON-serializable data to the given path."""
+    write_atomic(orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE), json_path)
+
+
+def save_known_atomic(known: set, json_path: str):
+    """Atomically rewrites (compacts) the known-basename log, one sorted name per line."""
+    write_atomic("".join(f"{name}\n" for name in sorted(known)).encode("utf-8"), json_path)
+
+
+def append_known(new_basenames: list, json_path: str):
+    """Appends newly seen basenames to the known-basename log and fsyncs it."""
+    with open(json_path, "a", encoding="utf-8") as f:
+        f.write("".join(f"{name}\n" for name in new_basenames))
+        f.flush()
+        os.fsync(f.fileno())
+
+
 # =============================================================================
 # AGENT 2: Gemini PDF Extractor
 # =============================================================================
@@ -137,10 +255,10 @@ try:
     genai_client = genai.Client(
         api_key=gemini_api_keys[gemini_api_key_id]
     )
-    print("Successfully initialized Gemini client.")
+    logger.info("Successfully initialized Gemini client.")
 except Exception as e:
-    print(f"Error initializing Gemini client: {e}", file=sys.stderr)
-    print("Please ensure 'GEMINI_API_KEYS' is set correctly in your .env file.", file=sys.stderr)
+    logger.error("Error initializing Gemini client: %s", e)
+    logger.error("Please ensure 'GEMINI_API_KEYS' is set correctly in your .env file.")
     genai_client = None  # Set to None so the loop can check
 
 
@@ -193,234 +311,502 @@ model_config = types.GenerateContentConfig(
         description=structured_output_schema_description,
         required=list(structured_output_schema.keys()),
         properties=properties,
+        # Fixed key order keeps the model's output layout stable across calls
+        property_ordering=list(structured_output_schema.keys()),
     ),
     system_instruction=[
         types.Part.from_text(text=system_prompt),
     ]
 )
 
-def get_gemini_output(pdf_url: str):
-    """
-    Fetches a PDF from a URL and sends it to the Gemini API
-    for structured data extraction.
-    """
-    if not genai_client:
-        print("[Error] Gemini client not initialized. Cannot extract data.", file=sys.stderr)
+
+def load_cached_output(cache_path: pathlib.Path):
+    """Returns a previously extracted result from the cache, or None on a miss."""
+    if not cache_path.exists():
         return None
-        
-    print(f"Attempting to download PDF from: {pdf_url}")
     try:
-        # Download the PDF content from the URL
-        response = requests.get(pdf_url)
+        with open(cache_path, "rb") as f:
+            return orjson.loads(f.read())
+    except Exception:
+        return None
+
+
+def rotate_gemini_api_key():
+    """Switches the shared Gemini client to the next API key, if more than one is configured."""
+    global gemini_api_key_id, genai_client
+    if len(gemini_api_keys) < 2:
+        return
+    gemini_api_key_id = (gemini_api_key_id + 1) % len(gemini_api_keys)
+    genai_client = genai.Client(api_key=gemini_api_keys[gemini_api_key_id])
+    logger.info("Rotated to Gemini API Key ID: %d", gemini_api_key_id)
+
+
+async def download_pdf(pdf_url: str, dest) -> str:
+    """
+    Streams a PDF from a URL into the open binary file dest, one chunk at a time.
+
+    Returns:
+        str: The SHA-256 hex digest of the downloaded bytes.
+    """
+    digest = hashlib.sha256()
+    async with CLIENT.stream("GET", pdf_url) as response:
         response.raise_for_status()  # Raise an exception for bad status codes
-        pdf_bytes = response.content
-        print("PDF downloaded successfully.")
-    except requests.exceptions.RequestException as e:
-        print(f"\n[Error] Error fetching PDF from URL: {e}", file=sys.stderr)
+        async for chunk in response.aiter_bytes():
+            digest.update(chunk)
+            dest.write(chunk)
+    return digest.hexdigest()
+
+
+async def probe_cache_path(pdf_url: str, cache_dir: str = DEFAULT_CACHE_DIR):
+    """
+    Probes a PDF with a HEAD request and returns a cache path keyed by its URL and
+    validator (ETag, else Last-Modified), so an unchanged PDF can be matched
+    without downloading it.
+
+    Returns:
+        pathlib.Path | None: The cache path, or None if the server gave no ETag or
+        Last-Modified (Content-Length alone can't tell two same-size PDFs apart).
+    """
+    try:
+        resp = await CLIENT.head(pdf_url)
+        resp.raise_for_status()
+    except httpx.HTTPError:
         return None
 
-    # Prepare the content for the Gemini API
-    contents = [
-        types.Part.from_bytes(
-            data=pdf_bytes,
-            mime_type='application/pdf',
-        )
-    ]
+    validator = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+    if not validator:
+        return None
+    key = hashlib.sha256(f"{pdf_url}\n{validator}".encode("utf-8")).hexdigest()
+    return pathlib.Path(cache_dir) / "head" / f"{key}.json"
 
-    trial = 0
-    while True:
-        trial += 1
-        print('\r\x1b[2K', end='')
-        print(f"Attempt #{trial} | Retrieving Model Output for {pdf_url}...", end='')
 
+async def delete_uploaded_files(uploads: list):
+    """Best-effort removal of PDFs uploaded to the Gemini File API."""
+    for client, file_ref in uploads:
         try:
-            # Send the request to the model
-            response = genai_client.models.generate_content(
-                model="gemini-flash-latest",
-                contents=contents,
-                config=model_config
-            )
+            await asyncio.to_thread(client.files.delete, name=file_ref.name)
+        except Exception:
+            pass
 
-            if (response.parsed):
-                break  # Success!
-            else:
-                print(f"\nAttempt #{trial} | Received empty response. Retrying in 5s...")
 
-        except Exception as e:
-            print(f"\nAttempt #{trial} | Error during API call: {e}. Retrying in 5s...")
-            # Simple API key rotation logic (if you have multiple)
-            # global gemini_api_key_id, genai_client
-            # gemini_api_key_id = (gemini_api_key_id + 1) % len(gemini_api_keys)
-            # genai_client = genai.Client(api_key=gemini_api_keys[gemini_api_key_id])
-            # print(f"Rotated to Gemini API Key ID: {gemini_api_key_id}")
-            
-        sleep(5)
+async def get_gemini_output(pdf_path: str, pdf_hash: str, pdf_url: str,
+                            cache_dir: str = DEFAULT_CACHE_DIR):
+    """
+    Sends an already-downloaded PDF to the Gemini API for structured data extraction.
+
+    The PDF at pdf_path is uploaded through the Gemini File API, so it is never
+    held in memory whole; retries reuse the uploaded file. Results are cached
+    under cache_dir by pdf_hash (the SHA-256 of the PDF bytes), so a PDF re-posted
+    under a different URL or name is not sent to Gemini again.
+
+    Gives up and returns None after MAX_TRIES failed attempts.
+    """
+    if not genai_client:
+        logger.error("Gemini client not initialized. Cannot extract data.")
+        return None
+
+    uploads = []  # (client, file) pairs; uploaded files are scoped to the key that uploaded them
+    try:
+        cache_path = pathlib.Path(cache_dir) / f"{pdf_hash}.json"
+        cached = load_cached_output(cache_path)
+        if cached:
+            logger.info("Using cached model output for %s (%s).", pdf_url, cache_path.name)
+            return cached
 
-    print('\r\x1b[2K', end='')
-    print(f"Attempt #{trial} | Model Output Retrieved for {pdf_url}.")
-    return response.parsed
+        for trial in range(1, MAX_TRIES + 1):
+            logger.debug("Attempt #%d | Retrieving Model Output for %s...", trial, pdf_url)
+            client = genai_client
+
+            try:
+                # Upload once per API key; later attempts on the same key reuse the file
+                if not uploads or uploads[-1][0] is not client:
+                    file_ref = await asyncio.to_thread(
+                        client.files.upload,
+                        file=pdf_path,
+                        config={"mime_type": "application/pdf"}
+                    )
+                    uploads.append((client, file_ref))
+
+                # Send the request to the model (the SDK is sync, so run it in a thread)
+                response = await asyncio.to_thread(
+                    client.models.generate_content,
+                    model=GEMINI_MODEL,
+                    contents=[uploads[-1][1]],
+                    config=model_config
+                )
+
+                # Only a JSON object can become an incident row
+                parsed = response.parsed
+                if isinstance(parsed, dict) and parsed:
+                    break  # Success!
+                else:
+                    logger.warning("Attempt #%d | Received empty or invalid response for %s.", trial, pdf_url)
+
+            except Exception as e:
+                logger.warning("Attempt #%d | Error during API call for %s: %s", trial, pdf_url, e)
+                # Only key-level failures rotate; errors specific to this PDF (e.g. a 400)
+                # must not move every task off a working key. Skip if another task already rotated.
+                if (isinstance(e, errors.APIError) and e.code in ROTATE_KEY_STATUS_CODES
+                        and client is genai_client):
+                    rotate_gemini_api_key()
+
+            if trial == MAX_TRIES:
+                logger.error("Giving up on %s after %d attempts.", pdf_url, MAX_TRIES)
+                return None
+
+            # Exponential backoff with jitter so concurrent tasks don't retry in lockstep
+            delay = min(MAX_BACKOFF, 2 ** trial) + random.random()
+            logger.debug("Retrying %s in %.1fs...", pdf_url, delay)
+            await asyncio.sleep(delay)
+
+        logger.info("Attempt #%d | Model Output Retrieved for %s.", trial, pdf_url)
 
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            save_json_atomic(parsed, str(cache_path))
+        except Exception as e:
+            logger.warning("Could not cache model output for %s: %s", pdf_url, e)
+
+        return parsed
+    finally:
+        await delete_uploaded_files(uploads)
 
 # =============================================================================
 # AGENT 3: Supabase Uploader
 # =============================================================================
 
-def init_supabase_client():
+async def init_supabase_client():
     """
-    Initializes and returns the Supabase client.
+    Initializes and returns the async Supabase client.
     """
     url = os.environ.get("SUPABASE_URL")
     key = os.environ.get("SUPABASE_KEY")
     
     if not url or not key:
-        print("Error: SUPABASE_URL and SUPABASE_KEY must be set in your .env file.", file=sys.stderr)
+        logger.error("SUPABASE_URL and SUPABASE_KEY must be set in your .env file.")
         return None
         
-    print("Connecting to Supabase...")
+    logger.info("Connecting to Supabase...")
     try:
-        supabase: Client = create_client(url, key)
-        print("Successfully connected to Supabase.")
+        supabase: AsyncClient = await acreate_client(url, key)
+        logger.info("Successfully connected to Supabase.")
         return supabase
     except Exception as e:
-        print(f"Error connecting to Supabase: {e}", file=sys.stderr)
+        logger.error("Error connecting to Supabase: %s", e)
         return None
 
-def add_incident(supabase: Client, incident_data: dict):
+async def add_incidents(supabase: AsyncClient, rows: list):
     """
-    Inserts a new incident into the 'incidents' table.
+    Inserts a batch of new incidents into the 'incidents' table in a single request,
+    falling back to one insert per row only if the batch insert raises.
     """
     if not supabase:
-        print("Supabase client is not initialized. Cannot add incident.", file=sys.stderr)
+        logger.error("Supabase client is not initialized. Cannot add incidents.")
         return
 
-    print(f"Attempting to add new incident for mine: {incident_data.get('mine')}")
+    if not rows:
+        return
+
+    logger.info("Attempting to add %d new incident(s) for mines: %s",
+                len(rows), ", ".join(str(row.get("mine")) for row in rows))
     
     try:
         # Assumes your table is named 'incidents'
-        data, count = supabase.table('incidents').insert([incident_data]).execute()
-        
-        if data and len(data[1]) > 0:
-            print("Successfully added new incident to the 'incidents' table.")
-        else:
-            print("Failed to add incident. No data returned or error occurred.", file=sys.stderr)
-            print(f"Full response: {data}, {count}", file=sys.stderr)
-            
+        response = await supabase.table('incidents').insert(rows).execute()
     except Exception as e:
-        print(f"An error occurred while inserting data: {e}", file=sys.stderr)
+        # PostgREST rejected the batch (or it never arrived), so nothing was written
+        logger.error("An error occurred while inserting data: %s", e)
+    else:
+        if response.data:
+            logger.info("Successfully added %d new incident(s) to the 'incidents' table.", len(response.data))
+        else:
+            # No error, so the rows may well have been written; retrying could duplicate them
+            logger.error("Batch insert returned no data; not retrying to avoid duplicates.")
+            logger.error("Full response: %s", response)
+            for row in rows:
+                logger.error("Unconfirmed incident row: %s", orjson.dumps(row).decode("utf-8"))
+        return
+
+    # The batch is all-or-nothing, so one rejected row would drop every incident
+    # from this poll; retry row by row so only the bad rows are lost (and logged).
+    if len(rows) == 1:
+        logger.error("Unsaved incident row: %s", orjson.dumps(rows[0]).decode("utf-8"))
+        return
+
+    logger.info("Retrying %d incident(s) one row at a time.", len(rows))
+    for row in rows:
+        try:
+            response = await supabase.table('incidents').insert([row]).execute()
+        except Exception as e:
+            logger.error("An error occurred while inserting incident for mine %s: %s", row.get("mine"), e)
+            logger.error("Unsaved incident row: %s", orjson.dumps(row).decode("utf-8"))
+            continue
+        if not response.data:
+            logger.error("Insert for mine %s returned no data. Full response: %s", row.get("mine"), response)
+            logger.error("Unconfirmed incident row: %s", orjson.dumps(row).decode("utf-8"))
+
+# =============================================================================
+# WAKE-UP TRIGGERS
+# =============================================================================
+
+async def start_kick_server(wake: asyncio.Event, port: int, host: str = DEFAULT_KICK_HOST):
+    """
+    Starts a minimal HTTP endpoint that sets wake on 'POST /kick', so a webhook
+    or a plain `curl -X POST` can trigger an immediate poll.
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Drain the headers; any request body is ignored
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass
+
+            if request_line.decode("latin-1").split()[:2] == ["POST", "/kick"]:
+                logger.info("Received POST /kick, polling now.")
+                wake.set()
+                status = "204 No Content"
+            else:
+                status = "404 Not Found"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode("ascii"))
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info("Listening for POST /kick on http://%s:%d/kick", host, port)
+    return server
+
+
+def install_wake_signal(wake: asyncio.Event):
+    """Sets wake on SIGUSR1 where the platform supports it (`kill -USR1 <pid>`)."""
+    if not hasattr(signal, "SIGUSR1"):
+        return
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, wake.set)
+    except (NotImplementedError, RuntimeError):
+        pass
+
+
+async def wait_for_next_poll(wake: asyncio.Event, interval: int):
+    """Sleeps for interval seconds, returning early if wake is set."""
+    logger.debug("Sleeping for %d seconds...", interval)
+    try:
+        await asyncio.wait_for(wake.wait(), timeout=interval)
+    except asyncio.TimeoutError:
+        pass
+    wake.clear()
 
 
 # =============================================================================
 # MAIN WORKFLOW LOOP
 # =============================================================================
 
-def main_loop(url: str, json_path: str, interval: int, dev_url: str = None, once: bool = False, 
-              supabase_client: Client = None, genai_client_obj: genai.Client = None):
+async def download_and_extract(full_url: str, cache_dir: str = DEFAULT_CACHE_DIR):
+    """
+    Downloads a PDF once to a temporary file and runs Gemini extraction on it.
+    """
+    # Download once; every step below (and any retry) reuses the same file
+    fd, pdf_path = tempfile.mkstemp(suffix=".pdf")
+    try:
+        logger.debug("Attempting to download PDF from: %s", full_url)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pdf_hash = await download_pdf(full_url, f)
+            logger.debug("PDF downloaded successfully: %s", full_url)
+        except httpx.HTTPError as e:
+            logger.error("Error fetching PDF from URL %s: %s", full_url, e)
+            return None
+
+        return await get_gemini_output(pdf_path, pdf_hash, full_url, cache_dir=cache_dir)
+    finally:
+        if os.path.exists(pdf_path):
+            try:
+                os.remove(pdf_path)
+            except Exception:
+                pass
+
+
+async def process_alert(basename: str, full_url: str, semaphore: asyncio.Semaphore,
+                        cache_dir: str = DEFAULT_CACHE_DIR, probe: bool = False):
+    """
+    Runs extraction for a single new alert, skipping the download entirely when a
+    HEAD probe shows the PDF is unchanged since it was last extracted. The probe only
+    runs when probe is set (--dev-url runs, which re-extract the same URLs); in live
+    mode a URL maps to an already-known basename, so it would never hit.
+
+    Returns:
+        dict | None: The extracted incident row, or None if extraction failed.
+    """
+    async with semaphore:
+        logger.info("[Processing] Alert: %s | URL: %s", basename, full_url)
+        try:
+            probe_path = await probe_cache_path(full_url, cache_dir) if probe else None
+            extracted_data = load_cached_output(probe_path) if probe_path else None
+
+            if extracted_data:
+                logger.info("Using cached model output for %s (unchanged since last download).", full_url)
+            else:
+                # --- Step 2: Extract Data with Gemini ---
+                extracted_data = await download_and_extract(full_url, cache_dir=cache_dir)
+                if extracted_data and probe_path:
+                    try:
+                        probe_path.parent.mkdir(parents=True, exist_ok=True)
+                        save_json_atomic(extracted_data, str(probe_path))
+                    except Exception as e:
+                        logger.warning("Could not cache model output for %s: %s", full_url, e)
+
+            if extracted_data:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Extracted details for %s:\n%s", basename, json.dumps(extracted_data, indent=2))
+                return extracted_data
+
+            logger.error("Failed to get structured data for %s", basename)
+
+        except Exception as e:
+            logger.exception("Unhandled exception processing %s: %s", basename, e)
+
+        return None
+
+
+async def main_loop(url: str, json_path: str, interval: int, dev_url: str = None, once: bool = False,
+                    supabase_client: AsyncClient = None, genai_client_obj: genai.Client = None,
+                    cache_dir: str = DEFAULT_CACHE_DIR, kick_port: int = None):
     
     target_url = dev_url if dev_url else url
-    print(f"Watching for new safety alerts. URL={target_url!r} json={json_path} interval={interval}s")
+    logger.info("Watching for new safety alerts. URL=%r json=%s interval=%ss", target_url, json_path, interval)
     
     known = load_known(json_path)
-    print(f"Loaded {len(known)} known alerts from {json_path!r}")
+    logger.info("Loaded %d known alerts from %r", len(known), json_path)
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_PDFS)
+    last_etag = None
+    last_modified = None
+
+    # Set by SIGUSR1 or POST /kick to cut the current sleep short
+    wake = asyncio.Event()
+    install_wake_signal(wake)
+    kick_server = await start_kick_server(wake, kick_port) if kick_port else None
 
     while True:
         try:
-            html = fetch_html(target_url)
+            html, last_etag, last_modified = await fetch_html(
+                target_url, etag=last_etag, last_modified=last_modified
+            )
         except Exception as e:
-            print(f"[ERROR] Failed to fetch page: {e}", file=sys.stderr)
+            logger.error("Failed to fetch page: %s", e)
             if once:
                 break
-            time.sleep(interval)
+            await wait_for_next_poll(wake, interval)
+            continue
+
+        if html is None:
+            logger.debug("Page not modified since last poll.")
+            if once:
+                logger.info("Run complete (--once specified). Exiting.")
+                break
+            await wait_for_next_poll(wake, interval)
             continue
 
         base = target_url
-        found_urls = extract_pdf_names_and_urls(html, base_url=base)
+        try:
+            found_urls = extract_pdf_names_and_urls(html, base_url=base)
 
-        # Compute which are new (present in found but not in known)
-        new_alerts = {}
-        new_basenames = []
-        for basename, full_url in found_urls.items():
-            if basename not in known:
-                new_alerts[basename] = full_url
-                new_basenames.append(basename)
+            # Compute which are new (present in found but not in known)
+            new_basenames = sorted(found_urls.keys() - known)
+            new_alerts = {b: found_urls[b] for b in new_basenames}
+        except Exception as e:
+            logger.error("Failed to parse page: %s", e)
+            # Forget the validators so the next poll re-downloads instead of getting a 304
+            last_etag = last_modified = None
+            if once:
+                break
+            await wait_for_next_poll(wake, interval)
+            continue
 
         if new_alerts:
-            print(f"\n[NEW ALERTS FOUND] {len(new_alerts)} new:")
-            for n in new_basenames:
-                print(" -", n)
+            logger.info("[NEW ALERTS FOUND] %d new: %s", len(new_alerts), ", ".join(new_basenames))
             
-            # --- Save new alerts to JSON *before* processing ---
+            # --- Append new alerts to the log *before* processing ---
             # This prevents reprocessing a failed item on every poll
-            known.extend(new_basenames)
-            save_known_atomic(known, json_path)
-            print(f"Updated {json_path!r} (now {len(known)} total alerts).")
+            known.update(new_basenames)
+            append_known(new_basenames, json_path)
+            logger.info("Updated %r (now %d total alerts).", json_path, len(known))
             
-            print(f"\n--- Processing {len(new_alerts)} new alerts ---")
+            logger.info("--- Processing %d new alerts ---", len(new_alerts))
             
-            for basename, full_url in new_alerts.items():
-                print(f"\n[Processing] Alert: {basename} | URL: {full_url}")
-                try:
-                    # --- Step 2: Extract Data with Gemini ---
-                    extracted_data = get_gemini_output(full_url)
+            results = await asyncio.gather(*(
+                process_alert(basename, full_url, semaphore, cache_dir=cache_dir, probe=bool(dev_url))
+                for basename, full_url in new_alerts.items()
+            ))
+
+            # --- Step 3: Upload all extracted rows to Supabase in one insert ---
+            rows = [row for row in results if row]
+            await add_incidents(supabase_client, rows)
                     
-                    if extracted_data:
-                        print("--- Extracted Details ---")
-                        print(json.dumps(extracted_data, indent=2))
-                        print("-------------------------")
-                        
-                        # --- Step 3: Upload to Supabase ---
-                        add_incident(supabase_client, extracted_data)
-                    else:
-                        print(f"[Error] Failed to get structured data for {basename}", file=sys.stderr)
-                        
-                except Exception as e:
-                    print(f"[Error] Unhandled exception processing {basename}: {e}", file=sys.stderr)
-                    
-            print("\n--- Finished processing new alerts ---")
+            logger.info("--- Finished processing new alerts ---")
 
         else:
-            print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] No new alerts (found {len(found_urls)} total).")
+            logger.debug("No new alerts (found %d total).", len(found_urls))
 
         if once:
-            print("Run complete (--once specified). Exiting.")
+            logger.info("Run complete (--once specified). Exiting.")
             break
         
-        print(f"Sleeping for {interval} seconds...")
-        time.sleep(interval)
+        await wait_for_next_poll(wake, interval)
+
+    if kick_server:
+        kick_server.close()
+        await kick_server.wait_closed()
+    await CLIENT.aclose()
 
 
 # =============================================================================
 # SCRIPT EXECUTION
 # =============================================================================
 
+async def main(args: argparse.Namespace):
+    """Connects to Supabase inside the event loop, then runs the main workflow loop."""
+    # Initialize Supabase Client (from Agent 3)
+    supabase_client = await init_supabase_client()
+
+    await main_loop(
+        url=args.url, 
+        json_path=args.json, 
+        interval=args.interval, 
+        dev_url=args.dev_url, 
+        once=args.once,
+        supabase_client=supabase_client,
+        genai_client_obj=genai_client,
+        cache_dir=args.cache_dir,
+        kick_port=args.kick_port
+    )
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Watch DGMS safety alerts, extract data, and upload to Supabase.")
     parser.add_argument("--url", "-u", default=DEFAULT_URL, help="URL of the alerts page to poll (used if --dev-url not provided).")
-    parser.add_argument("--json", "-j", default=DEFAULT_JSON, help="JSON file path storing known alert names (list).")
+    parser.add_argument("--json", "-j", default=DEFAULT_JSON, help="Newline-delimited file storing known alert names (one per line).")
     parser.add_argument("--interval", "-i", type=int, default=DEFAULT_INTERVAL, help=f"Polling interval in seconds (default {DEFAULT_INTERVAL}).")
     parser.add_argument("--dev-url", "-d", help="URL of a dev page to use instead of the default URL.")
     parser.add_argument("--once", action="store_true", help="Run once and exit (handy for testing).")
+    parser.add_argument("--kick-port", "-k", type=int, help=f"Serve POST /kick on {DEFAULT_KICK_HOST}:<port> to trigger an immediate poll.")
+    parser.add_argument("--verbose", "-v", action="store_true", help="Enable debug logging (per-poll and per-attempt details).")
+    parser.add_argument("--cache-dir", "-c", default=DEFAULT_CACHE_DIR, help=f"Directory for cached Gemini extraction results (default {DEFAULT_CACHE_DIR}).")
 
     args = parser.parse_args()
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
 
-    # Initialize Supabase Client (from Agent 3)
-    supabase_client = init_supabase_client()
-    
     # Check if Gemini Client was initialized successfully (from Agent 2)
     if not genai_client:
-        print("Exiting due to Gemini client initialization failure.", file=sys.stderr)
+        logger.error("Exiting due to Gemini client initialization failure.")
         raise SystemExit(1)
 
     try:
         # Run the main workflow loop
-        main_loop(
-            url=args.url, 
-            json_path=args.json, 
-            interval=args.interval, 
-            dev_url=args.dev_url, 
-            once=args.once,
-            supabase_client=supabase_client,
-            genai_client_obj=genai_client
-        )
+        asyncio.run(main(args))
     except KeyboardInterrupt:
-        print("\nInterrupted by user — exiting.")
+        logger.info("Interrupted by user — exiting.")
         raise SystemExit(0)
\ No newline at end of file